@@ -7,22 +7,30 @@
 # ]
 # ///
 
+import argparse
+import concurrent.futures
 import contextlib
-import dataclasses
-import glob
-import itertools
+import errno
+import functools
+import mmap
+import optparse
 import os
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 from collections import abc
 from dataclasses import dataclass
 from types import ModuleType
-from typing import Optional, Type, TypeVar
+from typing import Any, Optional, Type, TypeVar, Union
 
-import mutagen.easyid3
+import mutagen.id3
+import yt_dlp  # type: ignore[import-untyped]
+import yt_dlp.options  # type: ignore[import-untyped]
+import yt_dlp.utils  # type: ignore[import-untyped]
 
 RSGAIN: bool
 if shutil.which("rsgain") is not None:
@@ -33,6 +41,26 @@ else:
 
 
 COMMENT_PREFIX: str = "usdx-yt-dl:"
+# prefix of the hidden download directories created inside song directories
+TEMP_DIR_PREFIX: str = ".usdx-yt-dl-"
+# download directories that haven't been modified for this many seconds are considered abandoned. Generous, so that
+# directories another run is still downloading into are left alone.
+STALE_TEMP_DIR_AGE: int = 24 * 60 * 60
+# set when the run is being aborted, in-process downloads check it to stop early
+ABORT: threading.Event = threading.Event()
+# files at least this size are memory mapped rather than read. Below it, which covers nearly all song txts, a plain
+# read is faster than setting up the mapping.
+MMAP_THRESHOLD: int = 256 * 1024
+# guards the temporary patch of yt-dlp in yt_dlp_options()
+_YT_DLP_OPTIONS_LOCK: threading.Lock = threading.Lock()
+
+# characters that may not appear in a usdb media tag
+_TAG_WHITESPACE: frozenset[str] = frozenset(" \t\n\r\f\v")
+# matches the leading block of #KEY:VALUE metadata lines in a song txt
+_HEADER_RE: re.Pattern = re.compile(r"(?:#[^\r\n]*(?:\r\n?|\n)?)*")
+# matches a single header line, key or value are empty if the line is malformed
+_METADATA_LINE_RE: re.Pattern = re.compile(r"#([^:\r\n]*):?([^\r\n]*)")
+_NEWLINE_RE: re.Pattern = re.compile(r"\r\n|\r|\n")
 
 
 M = TypeVar("M", bound="Metadata")
@@ -80,23 +108,92 @@ def utf8_contents(path: str) -> str:
     """
     Reads the contents of the file at the given path, making a best effort to convert any non UTF8 characters.
     """
-    with open(path, "rb") as fd:
-        contents: bytes = fd.read()
+    def decode(contents: Union[bytes, mmap.mmap]) -> str:
         try:
-            return contents.decode("utf-8")
+            return str(contents, "utf-8")
         except UnicodeDecodeError:
-            # Many files seem to use this encoding
-            result: str = contents.decode("CP1252")
             try:
-                # verify all characters are utf-8 compatible
-                result.encode("utf-8")
-            except UnicodeEncodeError as e:
+                # Many files seem to use this encoding. A strict decode rejects its few undefined bytes, and
+                # anything it does decode is valid unicode, so there is no need to verify the result separately.
+                return str(contents, "CP1252")
+            except UnicodeDecodeError as e:
                 raise EncodingError(f"File at '{path}' contains unexpected utf-8 incompatible bytes") from e
-            else:
-                return result
 
+    with open(path, "rb") as fd:
+        if os.fstat(fd.fileno()).st_size < MMAP_THRESHOLD:
+            return decode(fd.read())
+        # decode straight from the page cache rather than reading into an intermediate bytes object first
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            return decode(contents)
+
+
+def strip_comment_prefix(comment: Optional[str]) -> Optional[str]:
+    """
+    Returns the given raw comment without this tool's prefix, or None if it wasn't written by this tool.
+    """
+    if comment is None:
+        return None
+    stripped: str = comment.removeprefix(COMMENT_PREFIX)
+    return stripped if len(stripped) != len(comment) else None
+
+
+def move_file(src: str, directory: str) -> str:
+    """
+    Moves the file at src into the given directory and returns its new path. This is a plain rename when both are on
+    the same filesystem, only falling back to copying the file across filesystems.
+    """
+    dst: str = os.path.join(directory, os.path.basename(src))
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+    return dst
+
+
+def files_by_suffix(entries: abc.Iterable[os.DirEntry], *suffixes: str) -> dict[str, list[str]]:
+    """
+    Returns the paths of all files among the given directory entries, grouped by which of the given suffixes their
+    name ends in. Every suffix is present in the result. Like a glob, hidden files are not included.
+    """
+    result: dict[str, list[str]] = {suffix: [] for suffix in suffixes}
+    for entry in entries:
+        if entry.name.startswith(".") or not entry.name.endswith(suffixes) or not entry.is_file():
+            continue
+        suffix: str = next(suffix for suffix in suffixes if entry.name.endswith(suffix))
+        result[suffix].append(entry.path)
+    return result
+
+
+def yt_dlp_options(*args: str) -> "yt_dlp._YoutubeDLOptions":
+    """
+    Translates the given yt-dlp command line arguments to options for yt_dlp.YoutubeDL, exactly like the yt-dlp cli
+    would. Unlike yt_dlp.parse_options on its own, this includes the user's yt-dlp config files.
+
+    :raises optparse.OptParseError: The arguments or config files are invalid.
+    """
+    # yt_dlp.parse_options ignores config files whenever it is given explicit arguments, and it has no option to
+    # change that. Have it load them just like for the cli.
+    with _YT_DLP_OPTIONS_LOCK:
+        # not part of yt-dlp's declared interface, hence the getattr/setattr
+        parse_opts: abc.Callable[..., Any] = getattr(yt_dlp, "parseOpts")
+        setattr(yt_dlp, "parseOpts", functools.partial(parse_opts, ignore_config_files=False))
+        try:
+            return yt_dlp.parse_options(list(args)).ydl_opts
+        finally:
+            setattr(yt_dlp, "parseOpts", parse_opts)
 
-@dataclass(frozen=True, kw_only=True)
+
+def find_files(directory: str, *suffixes: str) -> list[str]:
+    """
+    Returns the paths of all files directly in the given directory with a name ending in any of the given suffixes.
+    """
+    with os.scandir(directory) as entries:
+        return [path for paths in files_by_suffix(entries, *suffixes).values() for path in paths]
+
+
+@dataclass(kw_only=True, slots=True)
 class Metadata:
     """
     Normalized metadata.
@@ -160,19 +257,19 @@ class Metadata:
         """
         Returns a tuple of video and audio tags.
         """
-
-        def regex(*, audio_only: bool = False) -> str:
-            return "(.*,)?%s=([^, \t\n\r\f\v]+)(,.*)?" % ("a" if audio_only else "v")
-
-        video_match: Optional[re.Match] = re.fullmatch(regex(), tag)
-        audio_match: Optional[re.Match] = re.fullmatch(regex(audio_only=True), tag)
-        return tuple(match.group(2) if match is not None else None for match in (video_match, audio_match))
+        tags: dict[str, str] = {}
+        for field in tag.split(","):
+            key, _, value = field.partition("=")
+            if key in ("v", "a") and value and _TAG_WHITESPACE.isdisjoint(value):
+                # last occurrence wins
+                tags[key] = value
+        return (tags.get("v", None), tags.get("a", None))
 
 
 class Song:
     def __init__(self, directory: str) -> None:
         self.path: str = directory
-        txt_files: abc.Sequence[str] = glob.glob(os.path.join(glob.escape(self.path), "*.txt"))
+        txt_files: abc.Sequence[str] = find_files(self.path, ".txt")
         if len(txt_files) != 1:
             raise UnexpectedState(
                 f"Found {len(txt_files)} txt files in '{self.path}'"
@@ -181,9 +278,13 @@ class Song:
 
         self.metadata: Metadata
         self.raw_metadata: dict[str, str]
+        # line terminator used by the file, header lines are written back with it to match the untouched body
+        self.newline: str
         self.raw_body: str
 
-        (self.metadata, self.raw_metadata, self.raw_body) = self._parse_file(self.txt_file)
+        (self.metadata, self.raw_metadata, self.newline, self.raw_body) = self._parse_file(self.txt_file)
+        # whether raw_metadata differs from the file's contents, i.e. whether it needs to be written back at all
+        self._dirty: bool = False
 
     @classmethod
     def _parse_file(
@@ -192,24 +293,26 @@ class Song:
         Metadata,
         dict[str, str],
         str,
+        str,
     ]:
         contents: str = utf8_contents(txt_file)
 
-        lines: abc.Sequence[str] = contents.splitlines()
-        comment_block: abc.Sequence[str] = list(
-            itertools.takewhile(lambda line: line.startswith("#"), lines)
-        )
-        body: str = "\n".join(lines[len(comment_block):])
-
-        def read_line(line: str) -> tuple[str, str]:
-            assert line.startswith("#")
-            split: abc.Sequence[str] = line[1:].split(":", maxsplit=1)
-            if len(split) != 2 or not all(split):
-                raise FileCorrupt(f"Invalid metadata line: '{line}' in file '{txt_file}'")
-            return (split[0], split[1])
+        header_match: Optional[re.Match] = _HEADER_RE.match(contents)
+        # the header pattern matches the empty string, so it always matches
+        assert header_match is not None
+        header_end: int = header_match.end()
+        comment_block: abc.Sequence[re.Match] = list(_METADATA_LINE_RE.finditer(contents, 0, header_end))
+        body: str = contents[header_end:]
+        newline_match: Optional[re.Match] = _NEWLINE_RE.search(contents)
+        newline: str = newline_match.group(0) if newline_match is not None else "\n"
 
         # TODO: this deletes comments if there is more than one
-        raw_metadata: dict[str, str] = dict(read_line(line) for line in comment_block)
+        raw_metadata: dict[str, str] = {}
+        for line in comment_block:
+            key, value = line.group(1, 2)
+            if not key or not value:
+                raise FileCorrupt(f"Invalid metadata line: '{line.group(0)}' in file '{txt_file}'")
+            raw_metadata[key] = value
 
         def get_required(field: str) -> str:
             result: Optional[str] = raw_metadata.get(field, None)
@@ -227,16 +330,31 @@ class Song:
             cover=raw_metadata.get("COVER", None),
             background=raw_metadata.get("BACKGROUND", None),
             video=raw_metadata.get("VIDEO", None),
-            comment=(
-                raw_comment[len(COMMENT_PREFIX):]
-                if (raw_comment := raw_metadata.get("COMMENT", None)) is not None
-                and raw_comment.startswith(COMMENT_PREFIX)
-                else None
-            )
+            comment=strip_comment_prefix(raw_metadata.get("COMMENT", None)),
         )
-        return (metadata, raw_metadata, body)
+        return (metadata, raw_metadata, newline, body)
+
+    @property
+    def mp3_path(self) -> Optional[str]:
+        return os.path.join(self.path, self.metadata.mp3) if self.metadata.mp3 is not None else None
+
+    @property
+    def video_path(self) -> Optional[str]:
+        return os.path.join(self.path, self.metadata.video) if self.metadata.video is not None else None
 
     def process(self) -> None:
+        # single directory listing, shared by all checks below. Only this song's media files are removed from the
+        # directory before the download, so it stays valid for everything else up to that point.
+        entries: dict[str, os.DirEntry] = self._scan_directory()
+        stale_before: float = time.time() - STALE_TEMP_DIR_AGE
+        for name, entry in list(entries.items()):
+            if name.startswith(TEMP_DIR_PREFIX) and entry.is_dir(follow_symlinks=False):
+                del entries[name]
+                # another run may be cleaning it up at the same time
+                with contextlib.suppress(FileNotFoundError):
+                    if entry.stat(follow_symlinks=False).st_mtime < stale_before:
+                        # partial download left behind by a run that was killed, the current run never uses these
+                        shutil.rmtree(entry.path, ignore_errors=True)
         files: tuple[Optional[str], Optional[str]] = (self.metadata.mp3, self.metadata.video)
         outdated: bool = any(
             filename is not None and f" [{tag}]." not in filename
@@ -249,106 +367,128 @@ class Song:
         )
         if outdated:
             # clean up old files
-            for filename in files:
-                if filename is not None:
+            for path in (self.mp3_path, self.video_path):
+                if path is not None:
                     with contextlib.suppress(FileNotFoundError):
-                        os.remove(os.path.join(self.path, filename))
+                        os.remove(path)
         else:
             mp3_found, video_found = tuple(
-                filename is not None
-                and os.path.exists(os.path.join(self.path, filename))
+                filename is not None and filename in entries
                 for filename in files
             )
             if mp3_found and (video_found or self.metadata.video is None):
                 # both mp3 and video are set -> nothing to do here, fix permissions just in case
-                self._set_id3_tags()
-                self._fix_permissions()
+                self._set_id3_tags(entries)
+                self._fix_permissions(entries.values())
                 return
             if mp3_found:
                 raise ConservativeSkip("Found mp3 file but no video, skipping")
             if video_found:
                 raise ConservativeSkip("Found video file but no mp3, skipping")
 
-        self._set_cover()
+        self._set_cover(entries)
         self._download()
         self._set_id3_tags()
         self._fix_permissions()
         self._write()
 
-    def _set_cover(self) -> None:
-        jpeg_files: abc.Sequence[str] = glob.glob(os.path.join(glob.escape(self.path), "*.jpg"))
+    def _set_cover(self, entries: abc.Mapping[str, os.DirEntry]) -> None:
+        """
+        :param entries: Snapshot of the song directory.
+        """
+        jpeg_files: abc.Sequence[str] = files_by_suffix(entries.values(), ".jpg")[".jpg"]
         if not jpeg_files:
-            self.metadata = dataclasses.replace(self.metadata, cover=None, background=None)
+            self.metadata.cover = None
+            self.metadata.background = None
         elif len(jpeg_files) == 1:
             file: str = os.path.basename(jpeg_files[0])
-            self.metadata = dataclasses.replace(self.metadata, cover=file, background=file)
+            self.metadata.cover = file
+            self.metadata.background = file
         else:
             raise UnexpectedState(f"Found more than one jpeg file in '{self.path}'")
 
     def _download(self) -> None:
         if self.metadata.video_tag is None and self.metadata.audio_tag is None:
             raise InsufficientData("No video or audio source found")
-        with tempfile.TemporaryDirectory() as temp_dir:
+        # keep the download on the song's filesystem so moving the files into place is a plain rename.
+        # Hidden, so it is never picked up as part of the song. Stale ones are cleaned up by process().
+        with tempfile.TemporaryDirectory(dir=self.path, prefix=TEMP_DIR_PREFIX) as temp_dir:
+            same_audio: bool = self.metadata.audio_tag is None or self.metadata.audio_tag == self.metadata.video_tag
+            if self.metadata.video_tag is not None:
+                self._yt_dlp(self.metadata.video_tag, temp_dir, video=True, audio=same_audio)
+            if not same_audio:
+                assert self.metadata.audio_tag is not None
+                self._yt_dlp(self.metadata.audio_tag, temp_dir, video=False, audio=True)
+
+            # account for intermediate *.f<format_id>.webm files
+            video_suffixes: tuple[str, ...] = ("].webm", "].mp4", "].mkv")
+            media_files: dict[str, list[str]]
             try:
-                same_audio: bool = self.metadata.audio_tag is None or self.metadata.audio_tag == self.metadata.video_tag
-                if self.metadata.video_tag is not None:
-                    subprocess.check_call(
-                        [
-                            "yt-dlp",
-                            *(
-                                ["--extract-audio", "--keep-video", "--audio-format", "mp3"]
-                                if same_audio
-                                else []
-                            ),
-                            # USDX has trouble with high res files
-                            "--format-sort",
-                            # TODO: make this configurable
-                            "res:1080",
-                            "--",
-                            self.metadata.video_tag
-                        ],
-                        cwd=temp_dir,
-                    )
-                if not same_audio:
-                    assert self.metadata.audio_tag is not None
-                    subprocess.check_call(
-                        ["yt-dlp", "--extract-audio", "--audio-format", "mp3", "--", self.metadata.audio_tag],
-                        cwd=temp_dir,
-                    )
-            except subprocess.CalledProcessError:
-                raise DownloadFailed("Something went wrong during download")
-
-            video_files: abc.Sequence[str] = list(
-                itertools.chain.from_iterable(
-                    # account for intermediate *.f<format_id>.webm files
-                    glob.iglob(os.path.join(glob.escape(temp_dir), f"*].{ext}"))
-                    for ext in ("webm", "mp4", "mkv")
-                )
-            )
+                with os.scandir(temp_dir) as temp_entries:
+                    media_files = files_by_suffix(temp_entries, *video_suffixes, ".mp3")
+            except FileNotFoundError:
+                raise DownloadFailed(f"Download directory '{temp_dir}' was removed during the download")
+            video_files: abc.Sequence[str] = [path for suffix in video_suffixes for path in media_files[suffix]]
             if self.metadata.video_tag is not None and len(video_files) != 1:
                 raise UnknownMediaFormat(f"Expected 1 video file after download, got {len(video_files)}")
-            mp3_files: abc.Sequence[str] = glob.glob(os.path.join(glob.escape(temp_dir), "*.mp3"))
+            mp3_files: abc.Sequence[str] = media_files[".mp3"]
             if len(mp3_files) != 1:
                 raise UnknownMediaFormat(f"Expected 1 mp3 file after download, got {len(mp3_files)}")
 
-
             mp3_path: str = mp3_files[0]
+            video_path: Optional[str] = video_files[0] if self.metadata.video_tag is not None else None
             self._rsgain(mp3_path)
-            shutil.move(mp3_path, self.path)
+            move_file(mp3_path, self.path)
+            if video_path is not None:
+                move_file(video_path, self.path)
 
-            video_name: Optional[str]
-            if self.metadata.video_tag is not None:
-                video_path: str = video_files[0]
-                shutil.move(video_path, self.path)
-                video_name = os.path.basename(video_path)
-            else:
-                video_name = None
-
-            self.metadata = dataclasses.replace(
-                self.metadata,
-                video=video_name,
-                mp3=os.path.basename(mp3_path),
-            )
+            self.metadata.video = os.path.basename(video_path) if video_path is not None else None
+            self.metadata.mp3 = os.path.basename(mp3_path)
+
+    @classmethod
+    def _yt_dlp(cls, tag: str, directory: str, *, video: bool, audio: bool) -> None:
+        """
+        Downloads the media for the given tag into directory. Runs yt-dlp in-process rather than as a subprocess so
+        that its startup and import cost is only paid once for the whole run.
+
+        :param video: Keep the downloaded video.
+        :param audio: Extract the audio to an mp3 file.
+        """
+        def check_abort(status: abc.Mapping[str, Any]) -> None:
+            # yt-dlp runs on this worker thread, so it never sees the main thread's KeyboardInterrupt
+            if ABORT.is_set():
+                # yt-dlp reports and swallows most exceptions raised from hooks, this is the one it lets through
+                raise yt_dlp.utils.DownloadCancelled("Download aborted")
+
+        args: list[str] = ["--paths", directory]
+        if video:
+            # USDX has trouble with high res files
+            # TODO: make this configurable
+            args.extend(("--format-sort", "res:1080"))
+        if audio:
+            args.extend(("--extract-audio", "--audio-format", "mp3"))
+            if video:
+                args.append("--keep-video")
+        try:
+            options: "yt_dlp._YoutubeDLOptions" = yt_dlp_options(*args)
+        except optparse.OptParseError as e:
+            # the last line holds the actual error, the rest is usage information
+            raise DownloadFailed(f"Invalid yt-dlp options: {str(e).splitlines()[-1]}")
+        # progress output is costly on slow terminals and unreadable when songs are processed in parallel.
+        # Errors are still reported.
+        options["quiet"] = True
+        options["noprogress"] = True
+        options["no_warnings"] = True
+        options["progress_hooks"] = [*options.get("progress_hooks", []), check_abort]
+        options["postprocessor_hooks"] = [*options.get("postprocessor_hooks", []), check_abort]
+        try:
+            with yt_dlp.YoutubeDL(options) as ydl:
+                if ydl.download([tag]) != 0:
+                    raise DownloadFailed("Something went wrong during download")
+        except yt_dlp.utils.DownloadCancelled:
+            raise DownloadFailed("Download aborted")
+        except yt_dlp.utils.DownloadError:
+            raise DownloadFailed("Something went wrong during download")
 
     @classmethod
     def _rsgain(cls, mp3: str) -> None:
@@ -364,34 +504,59 @@ class Song:
             ],
         )
 
-    def _set_id3_tags(self) -> None:
-        if self.metadata.mp3 is None:
+    def _scan_directory(self) -> dict[str, os.DirEntry]:
+        """
+        Returns a snapshot of the song directory's entries, by name.
+        """
+        with os.scandir(self.path) as entries:
+            return {entry.name: entry for entry in entries}
+
+    def _set_id3_tags(self, entries: Optional[abc.Mapping[str, os.DirEntry]] = None) -> None:
+        """
+        :param entries: Up to date snapshot of the song directory, if available. Saves checking for the mp3 file.
+        """
+        path: Optional[str] = self.mp3_path
+        if path is None:
             raise Exception("Can not set id3 tags without mp3 file present")
-        path: str = os.path.join(self.path, self.metadata.mp3)
-        if not os.path.exists(path):
+        exists: bool = self.metadata.mp3 in entries if entries is not None else os.path.exists(path)
+        if not exists:
             raise Exception(f"No mp3 file at {path}")
-        mp3: mutagen.easyid3.EasyID3 = mutagen.easyid3.EasyID3(path)
-        mp3["title"] = self.metadata.title
-        mp3["artist"] = self.metadata.artist
-        mp3["albumartist"] = "Various Artists"
-        mp3["album"] = "USDX library"
-        delete = ("date", "tracknumber")  # date should be the same for the entire album
-        for d in delete:
-            if d in mp3:
-                del mp3[d]
-        mp3.save()
-
-    def _fix_permissions(self) -> None:
-        for file in os.listdir(self.path):
-            file_path: str = os.path.join(self.path, file)
-            if os.path.isfile(file_path):
-                os.chmod(file_path, 0o640)
+        tags: mutagen.id3.ID3 = mutagen.id3.ID3(path)
+        frames: abc.Sequence[mutagen.id3.TextFrame] = (
+            mutagen.id3.TIT2(encoding=mutagen.id3.Encoding.UTF8, text=[self.metadata.title]),
+            mutagen.id3.TPE1(encoding=mutagen.id3.Encoding.UTF8, text=[self.metadata.artist]),
+            mutagen.id3.TPE2(encoding=mutagen.id3.Encoding.UTF8, text=["Various Artists"]),
+            mutagen.id3.TALB(encoding=mutagen.id3.Encoding.UTF8, text=["USDX library"]),
+        )
+        obsolete: abc.Sequence[str] = ("TDRC", "TRCK")  # date should be the same for the entire album
+        up_to_date: bool = all(
+            frame.FrameID in tags and str(tags[frame.FrameID]) == str(frame) for frame in frames
+        ) and not any(frame_id in tags for frame_id in obsolete)
+        if up_to_date:
+            # don't rewrite the file for nothing, this is the common case on repeated runs
+            return
+        for frame in frames:
+            tags.add(frame)
+        for frame_id in obsolete:
+            tags.delall(frame_id)
+        tags.save()
+
+    def _fix_permissions(self, entries: Optional[abc.Iterable[os.DirEntry]] = None) -> None:
+        """
+        :param entries: Up to date snapshot of the song directory, if available. Saves listing it again.
+        """
+        for entry in entries if entries is not None else self._scan_directory().values():
+            if entry.is_file(follow_symlinks=False):
+                os.chmod(entry.path, 0o640)
 
     def _set_raw(self, field: str, value: Optional[str]) -> None:
+        if self.raw_metadata.get(field, None) == value:
+            return
+        self._dirty = True
         if value is not None:
             self.raw_metadata[field] = value
-        elif field in self.raw_metadata:
-            del self.raw_metadata[field]
+        else:
+            self.raw_metadata.pop(field, None)
 
     def _write(self) -> None:
         self._set_raw("TITLE", self.metadata.title)
@@ -402,34 +567,70 @@ class Song:
         self._set_raw("VIDEO", self.metadata.video)
         self._set_raw("COMMENT", COMMENT_PREFIX + self.metadata.comment)
 
-        metadata_text: str = "\n".join(f"#{key}:{value}" for key, value in self.raw_metadata.items())
-        with open(self.txt_file, "w") as fd:
-            fd.write(metadata_text + "\n" + self.raw_body)
+        if not self._dirty:
+            # the body is never modified, so the file is already up to date
+            return
+        # write all pieces straight into one large buffer, no intermediate header or file sized strings
+        parts: list[str] = []
+        for key, value in self.raw_metadata.items():
+            parts.extend(("#", key, ":", value, self.newline))
+        parts.append(self.raw_body)
+        # line endings are already as in the original file, don't let text mode translate them
+        with open(self.txt_file, "w", buffering=1 << 20, newline="") as fd:
+            fd.writelines(parts)
+        self._dirty = False
 
 
-def main() -> None:
-    if len(sys.argv) != 2:
-        print("Usage: usdx-yt-dl.py <path-to-bulk-dir>")
-        exit(1)
+def process_song(song_dir: str) -> None:
+    # runs on worker threads: a single write keeps the line and its newline together, print() writes them separately
+    sys.stdout.write(f"processing '{song_dir}'...\n")
+    song: Song = Song(song_dir)
+    song.process()
 
-    all_songs_path: str = sys.argv[1]
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(prog="usdx-yt-dl.py")
+    parser.add_argument("all_songs_path", metavar="path-to-bulk-dir")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        # downloads are network bound, so a few more than the cpu count is fine, but don't hammer the servers
+        default=min(8, (os.cpu_count() or 1) * 2),
+        help="number of songs to process in parallel (default: %(default)s)",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("the number of jobs must be at least 1")
+
+    all_songs_path: str = args.all_songs_path
+    song_dirs: abc.Sequence[str]
+    with os.scandir(all_songs_path) as entries:
+        song_dirs = [entry.path for entry in entries if entry.is_dir()]
 
     count: int = 0
     errors: list[tuple[str, SkipException]] = []
-    for subdir in os.listdir(all_songs_path):
-        song_dir: str = os.path.join(all_songs_path, subdir)
-        if not os.path.isdir(song_dir):
-            continue
-
-        try:
-            print(f"processing '{song_dir}'...")
-            song: Song = Song(song_dir)
-            song.process()
-        except SkipException as e:
-            errors.append((song_dir, e))
-            continue
-
-        count += 1
+    # songs spend most of their time waiting on subprocesses, so threads are sufficient
+    executor: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        futures: dict[concurrent.futures.Future[None], str] = {
+            executor.submit(process_song, song_dir): song_dir for song_dir in song_dirs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except SkipException as e:
+                errors.append((futures[future], e))
+                continue
+
+            count += 1
+    except KeyboardInterrupt:
+        # make the songs that are still downloading stop as soon as possible rather than waiting for them
+        ABORT.set()
+        raise
+    finally:
+        # don't start any new songs if something unexpected went wrong
+        executor.shutdown(cancel_futures=True)
 
     print(f"Successfully processed {count} songs")
     if errors: